@@ -6,10 +6,16 @@ This version implements truly real-time streaming audio playback.
 
 import gradio as gr
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
 import json
+import functools
+import importlib.util
 import time
 import tempfile
 import os
+import socket
+import struct
 import threading
 import queue
 from typing import Tuple, Optional
@@ -21,14 +27,110 @@ import numpy as np
 # Configuration
 DEFAULT_BASE_URL = "https://zb7jbp4ph16jlc-5005.proxy.runpod.net"
 DEFAULT_VOICES = ["tara", "leah", "jess", "leo", "dan", "mia", "zac", "zoe"]
+REQUEST_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept-Encoding": "identity"  # Audio doesn't benefit from gzip
+}
+STREAM_QUEUE_SIZE = 64  # Max chunks buffered between the network reader and the UI
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')  # Canonical 44-byte PCM WAV header
+STREAM_IDLE_TIMEOUT = 120  # Seconds without data before the stream is considered timed out
+YIELD_INTERVAL = 0.25  # Seconds between streaming UI updates (chunks are coalesced in between)
+MAX_CHUNK_TIMINGS = 4096  # Timing samples kept per stream
 DEFAULT_TEXT = "Hello! This is a test of the Orpheus streaming text-to-speech system. The streaming mode should provide much lower latency compared to the regular batch processing mode."
 
+@functools.lru_cache(maxsize=32)
+def encode_payload(text: str, voice: str, model: Optional[str] = None) -> bytes:
+    """Encode a TTS request body, cached so repeated runs skip json.dumps"""
+    payload = {"input": text, "voice": voice}
+    if model:
+        payload["model"] = model
+    return json.dumps(payload).encode("utf-8")
+
+def wav_segment(wav_fields: tuple, pcm: bytes) -> bytes:
+    """Wrap PCM frames in their own WAV header so each streamed update is a complete file
+
+    Streaming gr.Audio only accepts raw bytes from Gradio 5 on, and it re-encodes every
+    update with ffmpeg, so the tester needs gradio>=5 and ffmpeg on PATH. A
+    (sample_rate, ndarray) tuple would be written to the file cache on every yield instead.
+    """
+    fields = list(wav_fields)
+    fields[1] = len(pcm) + 36
+    fields[12] = len(pcm)
+    return WAV_HEADER.pack(*fields) + pcm
+
+def abort_response(response: httpx.Response):
+    """Abort a streaming response so a read blocked in another thread returns"""
+    if response.http_version in ("HTTP/1.0", "HTTP/1.1"):
+        # The connection belongs to this response alone; shutting the socket down
+        # is what wakes a recv() already blocked in the reader thread
+        network_stream = response.extensions.get("network_stream")
+        sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    else:
+        # HTTP/2 multiplexes other streams over the same socket; closing the
+        # response resets only this stream
+        response.close()
+
+class StreamControl:
+    """Handles for one session's active stream, so Stop only aborts that stream"""
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.response = None
+        self.chunk_queue = None
+    
+    def stop(self):
+        """Flag the stream as stopped, wake its consumer and abort its download"""
+        self.stopped.set()
+        chunk_queue = self.chunk_queue
+        if chunk_queue is not None:
+            try:
+                chunk_queue.put_nowait(None)
+            except queue.Full:
+                pass  # The consumer has chunks to read and will see the flag
+        response = self.response
+        if response is not None:
+            abort_response(response)
+
+class LowLatencyAdapter(HTTPAdapter):
+    """HTTP adapter with Nagle disabled and TCP keep-alive enabled"""
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        return super().init_poolmanager(*args, **kwargs)
+
 class RealTimeStreamingTester:
     def __init__(self):
         self.base_url = DEFAULT_BASE_URL
-        self.streaming_active = False
-        self.audio_chunks = []
-        self.chunk_timings = []
+        self.chunk_timings = np.empty(MAX_CHUNK_TIMINGS, dtype=np.float32)
+        self.chunk_timing_count = 0
+        
+        # Shared session so repeated requests reuse keep-alive connections
+        self.session = requests.Session()
+        adapter = LowLatencyAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(REQUEST_HEADERS)
+        
+        # Streaming client; HTTP/2 (when h2 is installed) lets future concurrent
+        # streams share one connection
+        transport = httpx.HTTPTransport(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+            socket_options=LowLatencyAdapter.socket_options
+        )
+        self.client = httpx.Client(
+            transport=transport,
+            timeout=120,
+            headers=REQUEST_HEADERS
+        )
         
     def test_regular_tts(self, text: str, voice: str, base_url: str) -> Tuple[Optional[str], str]:
         """Test regular TTS endpoint"""
@@ -38,20 +140,13 @@ class RealTimeStreamingTester:
         self.base_url = base_url.rstrip('/')
         url = f"{self.base_url}/v1/audio/speech"
         
-        payload = {
-            "input": text,
-            "voice": voice,
-            "model": "orpheus"
-        }
-        
         start_time = time.time()
         status_msg = f"🔄 Generating speech with voice '{voice}'...\\n"
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
+                data=encode_payload(text, voice, "orpheus"),
                 timeout=120
             )
             
@@ -80,7 +175,7 @@ class RealTimeStreamingTester:
         except Exception as e:
             return None, status_msg + f"❌ Unexpected error: {e}"
     
-    def stream_tts_realtime(self, text: str, voice: str, base_url: str):
+    def stream_tts_realtime(self, text: str, voice: str, base_url: str, stream_state: Optional[dict] = None):
         """Stream TTS with real-time chunked audio playback"""
         if not text.strip():
             yield None, "❌ Please enter some text to generate speech.", ""
@@ -89,99 +184,161 @@ class RealTimeStreamingTester:
         self.base_url = base_url.rstrip('/')
         url = f"{self.base_url}/v1/audio/speech/stream"
         
-        payload = {
-            "input": text,
-            "voice": voice
-            # Removed buffer_size - server uses optimal default
-        }
-        
         start_time = time.time()
         status_msg = f"🔄 Starting real-time streaming TTS...\n"
         status_msg += f"⚙️ Voice: {voice}\n"  # Removed buffer info
         
         # Reset streaming state
-        self.streaming_active = True
-        self.audio_chunks = []
-        self.chunk_timings = []
+        # Keep this stream's handles in the caller's session state so that
+        # stop_streaming only ever touches this session's stream
+        control = StreamControl()
+        if stream_state is not None:
+            stream_state["control"] = control
+        self.chunk_timing_count = 0
+        receiver_stop = threading.Event()
         
         try:
-            response = requests.post(
-                url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                stream=True,
-                timeout=120
-            )
+            request = self.client.build_request("POST", url, content=encode_payload(text, voice))
+            response = self.client.send(request, stream=True)
             
             if response.status_code != 200:
+                response.read()
+                response.close()
                 error_msg = f"❌ HTTP {response.status_code}: {response.text}"
                 yield None, status_msg + error_msg, "Error occurred"
                 return
             
+            # Keep a handle so stop_streaming can abort the download immediately
+            control.response = response
+            
+            # Drain the socket on a background thread so decoding and UI updates
+            # never stall the download; the bounded queue provides backpressure
+            chunk_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            control.chunk_queue = chunk_queue
+            
+            def queue_put(item):
+                while not receiver_stop.is_set():
+                    try:
+                        chunk_queue.put(item, timeout=0.5)
+                        return
+                    except queue.Full:
+                        continue
+            
+            def receive_chunks():
+                try:
+                    # No chunk_size: httpx would otherwise hold data back until it fills
+                    for chunk in response.iter_bytes():
+                        if receiver_stop.is_set():
+                            return
+                        queue_put(chunk)
+                except Exception as e:
+                    queue_put(e)
+                finally:
+                    queue_put(None)
+            
+            threading.Thread(target=receive_chunks, daemon=True).start()
+            
             # Process stream in real-time chunks
             chunk_count = 0
             total_bytes = 0
             first_chunk_time = None
-            accumulated_audio = b""
+            header_buffer = bytearray()
             header_processed = False
-            wav_header = b""
+            wav_fields = None
+            block_align = 2
+            pending = bytearray()
+            audio_sent = False
+            last_chunk_size = 0
+            
+            last_yield_ts = start_time
+            idle_deadline = start_time + STREAM_IDLE_TIMEOUT
             
-            for chunk in response.iter_content(chunk_size=4096):
-                if not self.streaming_active:
+            while True:
+                # Flush pending audio once the yield interval has passed, even when
+                # the server has paused and no new chunk is arriving; stretch the
+                # interval while a backlog of chunks is still queued
+                current_time = time.time()
+                yield_interval = YIELD_INTERVAL * 4 if chunk_queue.qsize() else YIELD_INTERVAL
+                if len(pending) >= block_align and current_time - last_yield_ts >= yield_interval:
+                    last_yield_ts = current_time
+                    
+                    # Hand over only the whole frames received since the last update
+                    usable = len(pending) - len(pending) % block_align
+                    segment = wav_segment(wav_fields, pending[:usable])
+                    del pending[:usable]
+                    audio_sent = True
+                    
+                    # Update status
+                    elapsed = current_time - start_time
+                    status_msg_update = status_msg + f"📊 Chunk {chunk_count}: {last_chunk_size} bytes at {elapsed:.2f}s\\n"
+                    
+                    # Store timing info
+                    if self.chunk_timing_count < MAX_CHUNK_TIMINGS:
+                        self.chunk_timings[self.chunk_timing_count] = elapsed
+                        self.chunk_timing_count += 1
+                    
+                    # Yield the new audio; the streaming output appends it to playback
+                    yield segment, status_msg_update, f"Streaming... {chunk_count} chunks received"
+                    current_time = time.time()
+                
+                # Wait for the next chunk, but only until the next flush is due
+                timeout = idle_deadline - current_time
+                if len(pending) >= block_align:
+                    timeout = min(timeout, last_yield_ts + yield_interval - current_time)
+                try:
+                    chunk = chunk_queue.get(timeout=max(0, timeout))
+                except queue.Empty:
+                    if time.time() >= idle_deadline:
+                        raise
+                    continue
+                
+                if chunk is None or control.stopped.is_set():
                     break
+                if isinstance(chunk, Exception):
+                    raise chunk
                     
                 if chunk:
                     current_time = time.time()
+                    idle_deadline = current_time + STREAM_IDLE_TIMEOUT
+                    last_chunk_size = len(chunk)
                     
                     if first_chunk_time is None:
                         first_chunk_time = current_time
                         first_chunk_latency = first_chunk_time - start_time
                         status_msg += f"⚡ First chunk in: {first_chunk_latency:.3f}s\\n"
                     
-                    accumulated_audio += chunk
                     total_bytes += len(chunk)
                     chunk_count += 1
                     
-                    # Extract WAV header from first chunk
-                    if not header_processed and len(accumulated_audio) >= 44:
-                        wav_header = accumulated_audio[:44]
+                    # Parse and validate the WAV header from the first chunk(s)
+                    if not header_processed:
+                        header_buffer.extend(chunk)
+                        if len(header_buffer) < WAV_HEADER.size:
+                            continue
+                        wav_fields = WAV_HEADER.unpack_from(header_buffer)
+                        if (wav_fields[0], wav_fields[2], wav_fields[3], wav_fields[11]) != (b"RIFF", b"WAVE", b"fmt ", b"data"):
+                            raise ValueError("Stream did not start with a PCM WAV header")
+                        if wav_fields[5] != 1 or wav_fields[10] != 16:
+                            raise ValueError("Stream is not 16-bit PCM audio")
+                        block_align = wav_fields[9]
+                        status_msg += f"🎵 Sample rate: {wav_fields[7]} Hz\\n"
                         header_processed = True
-                    
-                    # Create incremental audio file for real-time playback
-                    if header_processed and len(accumulated_audio) > 44:
-                        # Create a proper WAV file with accumulated data
-                        temp_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-                        
-                        # Write WAV header
-                        temp_file.write(wav_header)
-                        
-                        # Write audio data
-                        audio_data = accumulated_audio[44:]
-                        temp_file.write(audio_data)
-                        
-                        # Update WAV header with correct sizes
-                        temp_file.seek(4)
-                        temp_file.write((len(audio_data) + 36).to_bytes(4, 'little'))
-                        temp_file.seek(40)
-                        temp_file.write(len(audio_data).to_bytes(4, 'little'))
-                        
-                        temp_file.close()
-                        
-                        # Update status
-                        elapsed = current_time - start_time
-                        status_msg_update = status_msg + f"📊 Chunk {chunk_count}: {len(chunk)} bytes at {elapsed:.2f}s\\n"
-                        
-                        # Store timing info
-                        self.chunk_timings.append(elapsed)
-                        
-                        # Yield the current audio state for real-time playback
-                        yield temp_file.name, status_msg_update, f"Streaming... {chunk_count} chunks received"
+                        pending.extend(memoryview(header_buffer)[WAV_HEADER.size:])
+                    else:
+                        # Queue the PCM until the next update; a split frame stays behind
+                        pending.extend(chunk)
             
             # Final processing
+            stopped = control.stopped.is_set()
             end_time = time.time()
             total_time = end_time - start_time
             
-            final_status = status_msg + f"✅ Streaming completed!\\n"
+            if stopped:
+                final_status = status_msg + f"🛑 Streaming stopped!\\n"
+                final_info = "🛑 Streaming stopped"
+            else:
+                final_status = status_msg + f"✅ Streaming completed!\\n"
+                final_info = "✅ Streaming completed!"
             final_status += f"⏱️ Total time: {total_time:.3f}s\\n"
             final_status += f"📦 Total chunks: {chunk_count}\\n"
             final_status += f"📁 Total size: {total_bytes:,} bytes\\n"
@@ -190,36 +347,34 @@ class RealTimeStreamingTester:
                 first_chunk_latency = first_chunk_time - start_time
                 final_status += f"🚀 First chunk latency: {first_chunk_latency:.3f}s\\n"
             
-            # Create final audio file
-            if accumulated_audio and len(accumulated_audio) > 44:
-                final_temp_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-                final_temp_file.write(wav_header)
-                final_temp_file.write(accumulated_audio[44:])
-                
-                # Update WAV header
-                final_temp_file.seek(4)
-                final_temp_file.write((len(accumulated_audio) - 8).to_bytes(4, 'little'))
-                final_temp_file.seek(40)
-                final_temp_file.write((len(accumulated_audio) - 44).to_bytes(4, 'little'))
-                
-                final_temp_file.close()
-                
-                yield final_temp_file.name, final_status, "✅ Streaming completed!"
+            usable = len(pending) - len(pending) % block_align
+            if usable:
+                yield wav_segment(wav_fields, pending[:usable]), final_status, final_info
+            elif audio_sent:
+                yield None, final_status, final_info
             else:
                 yield None, final_status + "❌ No audio data received", "No audio generated"
                 
-        except requests.exceptions.Timeout:
-            yield None, status_msg + "❌ Request timed out (>120s)", "Timeout error"
-        except requests.exceptions.RequestException as e:
+        except (httpx.TimeoutException, queue.Empty):
+            yield None, status_msg + f"❌ Request timed out (>{STREAM_IDLE_TIMEOUT}s)", "Timeout error"
+        except httpx.HTTPError as e:
             yield None, status_msg + f"❌ Network error: {e}", "Network error"
         except Exception as e:
             yield None, status_msg + f"❌ Unexpected error: {e}", "Unexpected error"
         finally:
-            self.streaming_active = False
+            receiver_stop.set()
+            control.chunk_queue = None
+            if control.response is not None:
+                control.response.close()
+                control.response = None
+            if stream_state is not None and stream_state.get("control") is control:
+                del stream_state["control"]
 
-    def stop_streaming(self):
-        """Stop active streaming"""
-        self.streaming_active = False
+    def stop_streaming(self, stream_state: Optional[dict] = None):
+        """Stop this session's active streaming"""
+        control = stream_state.get("control") if stream_state else None
+        if control is not None:
+            control.stop()
         return "🛑 Streaming stopped", "Stopped"
 
 def create_interface():
@@ -267,9 +422,11 @@ def create_interface():
                 gr.Markdown("### ⚡ Real-Time Streaming TTS")
                 streaming_btn = gr.Button("Start Streaming TTS", variant="primary")
                 stop_btn = gr.Button("Stop Streaming", variant="stop")
-                streaming_audio = gr.Audio(label="Streaming Audio Output", interactive=False)
+                # Needs gradio>=5 and ffmpeg; see wav_segment()
+                streaming_audio = gr.Audio(label="Streaming Audio Output", interactive=False, streaming=True, autoplay=True)
                 streaming_status = gr.Textbox(label="Streaming Status", lines=4, interactive=False)
                 streaming_info = gr.Textbox(label="Performance Info", lines=2, interactive=False)
+                stream_state = gr.State({})  # Per-session handles for the active stream
         
         # Event handlers
         regular_btn.click(
@@ -281,33 +438,16 @@ def create_interface():
         
         streaming_btn.click(
             fn=tester.stream_tts_realtime,
-            inputs=[text_input, voice_selector, base_url_input],
+            inputs=[text_input, voice_selector, base_url_input, stream_state],
             outputs=[streaming_audio, streaming_status, streaming_info],
             show_progress=False
         )
         
         stop_btn.click(
             fn=tester.stop_streaming,
+            inputs=[stream_state],
             outputs=[streaming_status, streaming_info]
         )
-        
-        # Auto-refresh streaming output every 0.5 seconds when streaming
-        interface.load(
-            None,
-            js="""
-            function() {
-                // Enable auto-refresh for streaming audio
-                setInterval(function() {
-                    const streamingAudio = document.querySelector('audio');
-                    if (streamingAudio && streamingAudio.src) {
-                        // Force reload of audio when source changes
-                        streamingAudio.load();
-                    }
-                }, 500);
-                return null;
-            }
-            """
-        )
     
     return interface
 